@@ -1,32 +1,63 @@
 import streamlit as st
-import google.generativeai as genai
-from supabase import create_client, Client
-import uuid
+from supabase import create_client, Client, ClientOptions
+import io
+import re
+import hashlib
 
 # Import from our new modules
-from config import TABLE_L4_STRUCTURED_RECORDS, TABLE_L5_RAW_MESSAGES
-from crypto_utils import derive_key
+from config import TABLE_L4_STRUCTURED_RECORDS, TABLE_L5_RAW_MESSAGES, HISTORY_PAGE_SIZE, MAX_HISTORY_TURNS, HISTORY_SUMMARY_STEP, MAX_DOC_BYTES
+from crypto_utils import derive_key, clear_cipher_cache, KDF_PBKDF2, KDF_SCRYPT
 from supabase_client import (
-    save_message,
-    create_interim_summary,
-    load_messages_for_conversation,
+    queue_message,
+    queue_interim_summary,
+    flush_messages,
+    settle_background_writes,
+    discard_pending_messages,
+    build_interim_summary,
+    prefetch_messages_for_conversation,
+    collect_messages,
+    get_latest_finalized_summary,
     load_conversation_history,
+    conversation_history_rev,
+    invalidate_conversation_history,
     save_language_preference
 )
-from crystallizer import finalize_summary
-from utils import load_prompt, load_summarize_prompt
+from crystallizer import finalize_summary, settle_finalized_summaries, discard_finalized_summaries, summarize_turns
+from utils import load_summarize_prompt, load_running_summary_prompt, get_history_prefix, to_api_turn, new_conversation_id
+
+EMAIL_PATTERN = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
 
 # --- Connections ---
-try:
-    url: str = st.secrets.supabase.url
-    key: str = st.secrets.supabase.key
-    supabase: Client = create_client(url, key)
+@st.cache_resource
+def get_model():
+    """Returns the Gemini model, shared across reruns and sessions.
+    The SDK is imported here so the login page never pays for loading it."""
+    import google.generativeai as genai
     genai.configure(api_key=st.secrets.gemini.api_key)
-    model = genai.GenerativeModel('gemini-1.5-flash')
+    return genai.GenerativeModel('gemini-1.5-flash')
+
+def get_supabase() -> Client:
+    """Returns this session's Supabase client, reused across reruns so its HTTP connections stay alive.
+    Not shared via st.cache_resource because auth.set_session binds it to one user."""
+    if "supabase" not in st.session_state:
+        st.session_state.supabase = create_client(
+            st.secrets.supabase.url, st.secrets.supabase.key,
+            options=ClientOptions(postgrest_client_timeout=30)
+        )
+    return st.session_state.supabase
+
+try:
+    supabase: Client = get_supabase()
 except Exception as e:
     st.error(f"Could not connect to services: {e}")
     st.stop()
 
+# Warm the prompt caches so the first message of a session skips the disk read
+for language in ("en", "ja"):
+    get_history_prefix(language)
+    load_summarize_prompt(language)
+    load_running_summary_prompt(language)
+
 # --- App ---
 st.title("PCL Navigator 🧠")
 
@@ -37,10 +68,78 @@ if 'encryption_key' not in st.session_state:
     st.session_state.encryption_key = None
 if "messages" not in st.session_state:
     st.session_state.messages = []
+if "api_history" not in st.session_state:
+    st.session_state.api_history = []
+if "chat_cache" not in st.session_state:
+    # Chat state of conversations opened earlier in this session, by conversation id
+    st.session_state.chat_cache = {}
+if "history_summary" not in st.session_state:
+    # Running summary of api_history[:history_summarized], sent instead of those turns
+    st.session_state.history_summary = ""
+    st.session_state.history_summarized = 0
 if "conversation_id" not in st.session_state:
-    st.session_state.conversation_id = str(uuid.uuid4())
+    st.session_state.conversation_id = new_conversation_id()
 if "language" not in st.session_state:
     st.session_state.language = "en"
+if "history_limit" not in st.session_state:
+    st.session_state.history_limit = HISTORY_PAGE_SIZE
+
+def set_chat_messages(messages):
+    """Shows `messages` in the chat and rebuilds the Gemini request history from them."""
+    st.session_state.messages = messages
+    st.session_state.api_history = [to_api_turn(msg["role"], msg["content"]) for msg in messages]
+    st.session_state.history_summary = ""
+    st.session_state.history_summarized = 0
+
+CHAT_STATE_KEYS = ("messages", "api_history", "history_summary", "history_summarized")
+
+def stash_chat_state():
+    """Keeps the open conversation's chat state so switching back to it needs no reload."""
+    if st.session_state.messages:
+        st.session_state.chat_cache[st.session_state.conversation_id] = {name: st.session_state[name] for name in CHAT_STATE_KEYS}
+
+def window_start(api_history):
+    """Returns the index of the first turn sent verbatim.
+    Starts on a user turn so roles keep alternating after the summary."""
+    cut = max(len(api_history) - MAX_HISTORY_TURNS, 0)
+    while cut < len(api_history) and api_history[cut]["role"] != "user":
+        cut += 1
+    return cut
+
+def seed_history_summary(supabase, key, conversation_id, source_hash):
+    """Covers the turns before the window of a reloaded conversation with its crystallized
+    summary, sparing a summarization call on the next message.
+    Only a summary built from all of the current messages qualifies; otherwise turns added
+    after it would be skipped, so build_request_history summarizes as usual."""
+    if not source_hash or len(st.session_state.api_history) - MAX_HISTORY_TURNS < HISTORY_SUMMARY_STEP:
+        return
+    summary = get_latest_finalized_summary(supabase, key, conversation_id, source_hash)
+    if summary:
+        st.session_state.history_summary = summary
+        st.session_state.history_summarized = window_start(st.session_state.api_history)
+
+def build_request_history(language):
+    """Returns the system prefix, a summary of older turns and the most recent turns verbatim."""
+    api_history = st.session_state.api_history
+    if len(api_history) - MAX_HISTORY_TURNS - st.session_state.history_summarized >= HISTORY_SUMMARY_STEP:
+        from google.api_core.exceptions import GoogleAPIError
+        cut = window_start(api_history)
+        try:
+            older_turns = api_history[st.session_state.history_summarized:cut]
+            st.session_state.history_summary = summarize_turns(model, st.session_state.history_summary, older_turns, language)
+            st.session_state.history_summarized = cut
+        except (GoogleAPIError, ValueError) as e:
+            # API errors, or a blocked response (ValueError from .text): send the older turns verbatim
+            # and retry on the next message
+            st.toast(f"Could not summarize earlier messages, sending them in full: {e}")
+
+    summary_turns = []
+    if st.session_state.history_summary:
+        summary_turns = [
+            {"role": "user", "parts": [f"Summary of the conversation so far:\n{st.session_state.history_summary}"]},
+            {"role": "model", "parts": ["Understood."]},
+        ]
+    return [*get_history_prefix(language), *summary_turns, *api_history[st.session_state.history_summarized:]]
 
 # --- Authentication Logic ---
 if not st.session_state.user_session or not st.session_state.encryption_key:
@@ -51,19 +150,33 @@ if not st.session_state.user_session or not st.session_state.encryption_key:
         email = st.text_input("Email")
         password = st.text_input("Password", type="password")
         submit_button = st.form_submit_button(label=form_choice)
-        if submit_button:
+        if submit_button and not (email and password):
+            st.warning("Please enter your email and password.")
+        elif submit_button and not EMAIL_PATTERN.fullmatch(email):
+            st.warning("Please enter a valid email address.")
+        elif submit_button:
             if form_choice == "Sign Up":
                 try:
-                    user_metadata = {"language_preference": "en"}
+                    user_metadata = {"language_preference": "en", "kdf": KDF_SCRYPT}
                     supabase.auth.sign_up({"email": email, "password": password, "options": {"data": user_metadata}})
                     st.success("Sign up successful! Please check your email to verify.")
                 except Exception as e:
                     st.error(f"Sign up failed: {e}")
             elif form_choice == "Login":
+                # Keys derived in this browser session, keyed by a digest of the password instead of the password itself.
+                # Kept in session_state rather than st.cache_data, so no other session can look them up. The ciphers
+                # built from a key are cached process-wide in crypto_utils until logout clears them.
+                derived_keys = st.session_state.setdefault("derived_keys", {})
+                password_digest = hashlib.sha256(password.encode()).hexdigest()
                 try:
                     user_session = supabase.auth.sign_in_with_password({"email": email, "password": password})
                     st.session_state.user_session = user_session
-                    st.session_state.encryption_key = derive_key(password, user_session.user.id.encode())
+                    kdf_name = user_session.user.user_metadata.get("kdf", KDF_PBKDF2)
+                    memo_key = (password_digest, user_session.user.id, kdf_name)
+                    if memo_key not in derived_keys:
+                        with st.spinner("Unlocking your encrypted data..."):
+                            derived_keys[memo_key] = derive_key(password, user_session.user.id.encode(), kdf_name)
+                    st.session_state.encryption_key = derived_keys[memo_key]
                     lang_pref = user_session.user.user_metadata.get("language_preference", "en")
                     st.session_state.language = lang_pref
                     st.rerun()
@@ -71,12 +184,27 @@ if not st.session_state.user_session or not st.session_state.encryption_key:
                     st.error(f"Login failed: {e}")
 else:
     # --- Main Application Logic ---
+    try:
+        model = get_model()
+    except Exception as e:
+        st.error(f"Could not connect to services: {e}")
+        st.stop()
+
     session = st.session_state.user_session
     encryption_key = st.session_state.encryption_key
     user_id = session.user.id
     user_email = session.user.email
     
-    supabase.auth.set_session(session.session.access_token, session.session.refresh_token)
+    # sign_in_with_password already bound this session's client, which refreshes its own tokens.
+    # set_session costs an auth round trip and rebuilds the PostgREST client (dropping its connection
+    # pool under any background writer), so it is only used if the client lost that binding.
+    bound_session = supabase.auth.get_session()
+    if not bound_session or bound_session.user.id != user_id:
+        supabase.auth.set_session(session.session.access_token, session.session.refresh_token)
+
+    # Rows from failed background writes are retried with the next turn
+    settle_background_writes()
+    settle_finalized_summaries(user_id)
 
     # --- Sidebar ---
     with st.sidebar:
@@ -93,36 +221,41 @@ else:
         st.selectbox("Language", options=lang_name_list, index=current_lang_index, key="lang_selector", on_change=on_lang_change)
         
         if st.button("Logout"):
+            discard_pending_messages()
+            with st.spinner("Finishing background work..."):
+                discard_finalized_summaries()
             st.session_state.user_session = None
             st.session_state.encryption_key = None
-            st.session_state.messages = []
+            clear_cipher_cache()
+            set_chat_messages([])
+            st.session_state.chat_cache = {}
             st.rerun()
 
         st.markdown("---")
 
         if st.button("New Chat ✨"):
             previous_conversation_id = st.session_state.conversation_id
+            # finalize_summary reads L5 back, so every buffered row must be saved first
+            flush_messages(supabase, encryption_key, user_id)
+            settle_background_writes(block=True)
             if st.session_state.messages:
-                with st.spinner("Finalizing last conversation..."):
-                    finalize_summary(model, supabase, encryption_key, previous_conversation_id, user_id, st.session_state.language)
+                finalize_summary(model, supabase, encryption_key, previous_conversation_id, user_id, st.session_state.language)
             
-            st.session_state.messages = []
-            st.session_state.conversation_id = str(uuid.uuid4())
+            stash_chat_state()
+            set_chat_messages([])
+            invalidate_conversation_history(user_id)
+            st.session_state.conversation_id = new_conversation_id()
             st.rerun()
 
         st.markdown("## Conversation History")
-        conversations = load_conversation_history(supabase, encryption_key, user_id)
-        if conversations:
-            for conv in conversations:
-                if st.button(conv['preview'], key=conv['conversation_id']):
-                    previous_conversation_id = st.session_state.conversation_id
-                    if st.session_state.messages and previous_conversation_id != conv['conversation_id']:
-                         with st.spinner("Finalizing last conversation..."):
-                            finalize_summary(model, supabase, encryption_key, previous_conversation_id, user_id, st.session_state.language)
-                    
-                    st.session_state.messages = load_messages_for_conversation(supabase, encryption_key, conv['conversation_id'])
-                    st.session_state.conversation_id = conv['conversation_id']
-                    st.rerun()
+        history_area = st.container()
+
+    # Re-query only when something changed the list; chat sends alone reuse it
+    history_key = (user_id, conversation_history_rev(user_id), st.session_state.history_limit)
+    if st.session_state.get("conversations_key") != history_key:
+        st.session_state.conversations = load_conversation_history(supabase, encryption_key, user_id, history_key[1], history_key[2])
+        # An empty result may be a failed load, so it is retried next run
+        st.session_state.conversations_key = history_key if st.session_state.conversations else None
 
     # --- Main Chat Interface ---
     for message in st.session_state.messages:
@@ -134,10 +267,13 @@ else:
         uploaded_files = prompt_data["files"]
         final_prompt_for_ai = user_text
         display_prompt = user_text
+        api_turn = None
 
         if uploaded_files:
             try:
                 uploaded_file = uploaded_files[0]
+                if uploaded_file.size > MAX_DOC_BYTES:
+                    raise ValueError(f"`{uploaded_file.name}` is larger than {MAX_DOC_BYTES // 1000} KB.")
                 file_content = uploaded_file.getvalue().decode("utf-8")
                 final_prompt_for_ai = f"Instruction: {user_text}\n\nDocument:\n---\n{file_content}"
                 display_prompt = f"**Instruction for `{uploaded_file.name}`:**\n{user_text}"
@@ -145,26 +281,84 @@ else:
                 st.error(f"Error reading file: {e}")
                 final_prompt_for_ai = None
 
+        if uploaded_files and final_prompt_for_ai:
+            # Upload the document once and refer to it, instead of resending its text every turn.
+            # The full text is still what gets encrypted into L5, for reloads and crystallization.
+            import google.generativeai as genai
+            from google.api_core.exceptions import GoogleAPIError
+            try:
+                with st.spinner("Uploading file..."):
+                    file_ref = genai.upload_file(io.BytesIO(uploaded_file.getvalue()), mime_type="text/plain", display_name=uploaded_file.name)
+                api_turn = {"role": "user", "parts": [f"Instruction: {user_text}\n\nDocument:", file_ref]}
+            except (GoogleAPIError, OSError) as e:
+                st.toast(f"Could not upload `{uploaded_file.name}`, sending it inline instead: {e}")
+
         if final_prompt_for_ai:
-            is_first_message = not st.session_state.messages
+            # A listed conversation already has its L4 record, even if its messages failed to load
+            is_first_message = not st.session_state.messages and not any(
+                conv['conversation_id'] == st.session_state.conversation_id for conv in st.session_state.conversations
+            )
             st.session_state.messages.append({"role": "user", "content": display_prompt})
-            save_message(supabase, encryption_key, st.session_state.conversation_id, "user", final_prompt_for_ai, user_id)
+            st.session_state.api_history.append(api_turn or to_api_turn("user", final_prompt_for_ai))
+            queue_message(st.session_state.conversation_id, "user", final_prompt_for_ai)
             
             if is_first_message:
-                create_interim_summary(supabase, encryption_key, st.session_state.conversation_id, user_id, final_prompt_for_ai)
+                # Saved with this turn; listed in the sidebar right away rather than re-queried
+                interim_summary = build_interim_summary(final_prompt_for_ai)
+                queue_interim_summary(st.session_state.conversation_id, interim_summary)
+                st.session_state.conversations.append({'conversation_id': st.session_state.conversation_id, 'preview': interim_summary['why_summary']})
+                st.session_state.conversations_key = history_key
             
-            with st.spinner("Thinking..."):
+            with st.chat_message("user"):
+                st.markdown(display_prompt)
+
+            with st.chat_message("assistant"):
+                placeholder = st.empty()
+                response_text = ""
                 try:
-                    ai_request_messages = st.session_state.messages[:-1] + [{"role": "user", "content": final_prompt_for_ai}]
-                    api_request_parts = [{"role": "user" if msg["role"] == "user" else "model", "parts": [msg["content"]]} for msg in ai_request_messages]
-                    SYSTEM_PROMPT = load_prompt(st.session_state.language)
-                    full_history = [{"role": "user", "parts": [SYSTEM_PROMPT]}, {"role": "model", "parts": ["Understood."]},] + api_request_parts
-                    
-                    response = model.generate_content(full_history)
-                    response_text = response.text
-                    
-                    st.session_state.messages.append({"role": "assistant", "content": response_text})
-                    save_message(supabase, encryption_key, st.session_state.conversation_id, "assistant", response_text, user_id)
+                    with st.spinner("Thinking..."):
+                        full_history = build_request_history(st.session_state.language)
+                        response = model.generate_content(full_history, stream=True)
+                    for chunk in response:
+                        response_text += chunk.text
+                        placeholder.markdown(response_text)
                 except Exception as e:
                     st.error(f"An error occurred with the Gemini API: {e}")
-            st.rerun()
\ No newline at end of file
+
+                # Keep whatever arrived before a mid-stream failure
+                if response_text:
+                    st.session_state.messages.append({"role": "assistant", "content": response_text})
+                    st.session_state.api_history.append(to_api_turn("assistant", response_text))
+                    queue_message(st.session_state.conversation_id, "assistant", response_text)
+
+            # One RPC per turn, written in the background
+            flush_messages(supabase, encryption_key, user_id)
+
+    # --- Conversation History (drawn last, so it already lists a conversation started above) ---
+    with history_area:
+        conversations = st.session_state.conversations
+        if len(conversations) >= st.session_state.history_limit:
+            if st.button("Load older conversations"):
+                st.session_state.history_limit += HISTORY_PAGE_SIZE
+                st.rerun()
+        if conversations:
+            for conv in conversations:
+                if st.button(conv['preview'], key=conv['conversation_id']):
+                    previous_conversation_id = st.session_state.conversation_id
+                    flush_messages(supabase, encryption_key, user_id)
+                    settle_background_writes(block=True)
+                    stash_chat_state()
+                    cached_state = st.session_state.chat_cache.get(conv['conversation_id'])
+                    # Otherwise fetch the selected conversation while the previous one is being finalized
+                    selected_messages = None if cached_state else prefetch_messages_for_conversation(supabase, encryption_key, conv['conversation_id'])
+                    if st.session_state.messages and previous_conversation_id != conv['conversation_id']:
+                        finalize_summary(model, supabase, encryption_key, previous_conversation_id, user_id, st.session_state.language)
+                    
+                    if cached_state:
+                        st.session_state.update(cached_state)
+                    else:
+                        selected, source_hash = collect_messages(selected_messages)
+                        set_chat_messages(selected)
+                        seed_history_summary(supabase, encryption_key, conv['conversation_id'], source_hash)
+                    st.session_state.conversation_id = conv['conversation_id']
+                    st.rerun()
\ No newline at end of file
@@ -1,2 +1,12 @@
 TABLE_L5_RAW_MESSAGES = "l5_raw_messages"
-TABLE_L4_STRUCTURED_RECORDS = "l4_structured_records"
\ No newline at end of file
+TABLE_L4_STRUCTURED_RECORDS = "l4_structured_records"
+VIEW_L4_LATEST_RECORDS = "l4_latest_records"
+HISTORY_PAGE_SIZE = 20
+
+# Gemini turns sent verbatim; older turns are folded into a running summary
+MAX_HISTORY_TURNS = 12
+# Turns allowed past the window before the summary is refreshed
+HISTORY_SUMMARY_STEP = 6
+
+# Largest uploaded document accepted in a chat turn
+MAX_DOC_BYTES = 200_000
\ No newline at end of file
@@ -1,16 +1,68 @@
 import base64
+import os
+from functools import lru_cache
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 
-def derive_key(password: str, salt: bytes) -> bytes:
-    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=480000)
+# Key derivation functions, recorded per user in auth metadata ("kdf").
+# Accounts created before scrypt have no entry and keep PBKDF2, or their data would no longer decrypt.
+KDF_PBKDF2 = "pbkdf2"
+KDF_SCRYPT = "scrypt"
+
+# First byte of an AES-GCM payload; Fernet tokens always start with 0x80,
+# so older rows are still recognised and decrypted with Fernet.
+AESGCM_VERSION = b"\x01"
+NONCE_SIZE = 12
+
+def derive_key(password: str, salt: bytes, kdf_name: str = KDF_PBKDF2) -> bytes:
+    if kdf_name == KDF_SCRYPT:
+        kdf = Scrypt(salt=salt, length=32, n=2**15, r=8, p=1)
+    else:
+        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=480000)
     return base64.urlsafe_b64encode(kdf.derive(password.encode()))
 
+# Cipher objects are cached process-wide, keyed by the raw key: the ciphers for the last 32 keys,
+# and those keys, stay in memory across sessions until evicted or until clear_cipher_cache runs.
+
+@lru_cache(maxsize=32)
+def _fernet(key: bytes) -> Fernet:
+    # Fernet instances are reusable; build one per key instead of one per message
+    return Fernet(key)
+
+@lru_cache(maxsize=32)
+def _aesgcm(key: bytes) -> AESGCM:
+    # A dedicated subkey, so the Fernet key material is never reused under another cipher
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"pcl-extension aes-gcm v1")
+    return AESGCM(hkdf.derive(base64.urlsafe_b64decode(key)))
+
+def clear_cipher_cache():
+    """Drops every cached cipher, and with them the keys they were built from (on logout).
+    Sessions still logged in simply rebuild theirs on their next encrypt or decrypt."""
+    _fernet.cache_clear()
+    _aesgcm.cache_clear()
+
 def encrypt_message(message: str, key: bytes) -> str:
-    f = Fernet(key)
-    return f.encrypt(message.encode()).decode()
+    nonce = os.urandom(NONCE_SIZE)
+    ciphertext = _aesgcm(key).encrypt(nonce, message.encode(), None)
+    return base64.urlsafe_b64encode(AESGCM_VERSION + nonce + ciphertext).decode()
 
 def decrypt_message(encrypted_message: str, key: bytes) -> str:
-    f = Fernet(key)
-    return f.decrypt(encrypted_message.encode()).decode()
\ No newline at end of file
+    payload = base64.urlsafe_b64decode(encrypted_message)
+    if payload[:1] != AESGCM_VERSION:
+        return _fernet(key).decrypt(encrypted_message.encode()).decode()
+    nonce, ciphertext = payload[1:1 + NONCE_SIZE], payload[1 + NONCE_SIZE:]
+    return _aesgcm(key).decrypt(nonce, ciphertext, None).decode()
+
+def decrypt_messages(encrypted_messages: list, key: bytes, fallback: str | None = None) -> list:
+    """Decrypts a batch of messages; undecryptable items become fallback."""
+    decrypted = []
+    for encrypted_message in encrypted_messages:
+        try:
+            decrypted.append(decrypt_message(encrypted_message, key))
+        except Exception:
+            decrypted.append(fallback)
+    return decrypted
@@ -1,35 +1,120 @@
 import streamlit as st
 import json
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING
 from supabase import Client
-from google.generativeai.generative_models import GenerativeModel
+
+if TYPE_CHECKING:
+    from google.generativeai.generative_models import GenerativeModel
 
 # Import from our other new modules
-from supabase_client import load_messages_for_conversation, get_latest_l4_record, insert_finalized_summary
-from utils import load_summarize_prompt
+from supabase_client import (
+    get_db_executor,
+    invalidate_conversation_history,
+    decrypt_raw_messages,
+    messages_source_hash,
+    load_raw_messages,
+    get_latest_l4_row,
+    get_l4_summary,
+    insert_finalized_summary,
+)
+from utils import load_summarize_prompt, load_running_summary_prompt, render_prompt
+
+def _strip_code_fence(text: str) -> str:
+    """Returns the body of a ```json fenced block, or the text itself if it is not fenced."""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("```", 2)[1].removeprefix("json").strip()
+    return text
+
+def _crystallize(model: "GenerativeModel", supabase: Client, key: bytes, conversation_id: str, user_id: str, prompt_parts: tuple, messages_future: Future) -> bool:
+    # Runs on the finalize pool: no Streamlit calls here, errors propagate to the future
+    previous = get_latest_l4_row(supabase, conversation_id)
+    previous_record_id = previous['id'] if previous else None
+
+    rows = messages_future.result()
+    if not rows: return False
+    # Nothing was added since the last crystallization, so skip the Gemini call
+    source_hash = messages_source_hash(rows)
+    if previous and source_hash == previous['source_hash']: return False
+    messages = decrypt_raw_messages(rows, key)
+
+    # Get the previous summary to provide it as context for refinement.
+    # An interim draft only restates the first message, which the prompt already carries.
+    previous_summary_text = ""
+    if previous and previous['status'] != "interim":
+        previous_summary_text = get_l4_summary(supabase, key, previous['id'])
+
+    conversation_text = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+    prompt = render_prompt(prompt_parts, conversation_text=conversation_text, previous_summary=previous_summary_text)
+
+    response = model.generate_content(prompt)
+    summary_obj = json.loads(_strip_code_fence(response.text))
 
-def finalize_summary(model: GenerativeModel, supabase: Client, key: bytes, conversation_id: str, user_id: str, language: str):
+    # Insert the new finalized record
+    insert_finalized_summary(supabase, key, conversation_id, user_id, summary_obj, previous_record_id, source_hash)
+    return True
+
+@st.cache_resource
+def get_finalize_executor() -> ThreadPoolExecutor:
+    """Returns the worker pool for finalizations.
+    Kept apart from get_db_executor, so Gemini calls lasting seconds never hold up other sessions' Supabase I/O."""
+    return ThreadPoolExecutor(max_workers=4)
+
+def finalize_summary(model: "GenerativeModel", supabase: Client, key: bytes, conversation_id: str, user_id: str, language: str):
     """
     Orchestrates the process of finalizing a conversation summary.
     This is the core business logic for crystallization.
+    Runs on the finalize pool so the page is not held up by the Gemini call;
+    the outcome is reported by settle_finalized_summaries on a later rerun.
+    """
+    # Fetch the messages on the DB pool while the finalization reads the previous summary, so the two round trips overlap
+    messages_future = get_db_executor().submit(load_raw_messages, supabase, conversation_id)
+    future = get_finalize_executor().submit(
+        _crystallize, model, supabase, key, conversation_id, user_id, load_summarize_prompt(language), messages_future
+    )
+    st.session_state.setdefault("finalize_futures", []).append((future, messages_future))
+
+def settle_finalized_summaries(user_id: str):
+    """Reports finished background finalizations and refreshes the sidebar for new records."""
+    still_running = []
+    for future, messages_future in st.session_state.get("finalize_futures", []):
+        if future.cancelled():
+            continue
+        if not future.done():
+            still_running.append((future, messages_future))
+        elif future.exception():
+            st.error(f"Failed to finalize summary: {future.exception()}")
+        elif future.result():
+            invalidate_conversation_history(user_id)
+            st.toast("Knowledge crystallized!")
+    st.session_state.finalize_futures = still_running
+
+def discard_finalized_summaries():
+    """Cancels queued finalizations and waits for running ones, dropping their outcome.
+    Called on logout, so no finalization keeps using the session's client under the next user's login."""
+    pending = st.session_state.get("finalize_futures", [])
+    futures = [future for pair in pending for future in pair]
+    for future in futures:
+        future.cancel()
+    wait(futures)
+    st.session_state.finalize_futures = []
+
+def summarize_turns(model: "GenerativeModel", previous_summary: str, turns: list, language: str) -> str:
+    """
+    Folds Gemini content turns into a running summary of the conversation so far.
+    Used to keep chat requests bounded; raises on API errors so callers can fall back.
     """
-    messages = load_messages_for_conversation(supabase, key, conversation_id)
-    if not messages: return
-
-    # Get the previous summary to provide it as context for refinement
-    previous_record_id, previous_summary_text = get_latest_l4_record(supabase, key, conversation_id)
-
-    conversation_text = "\n".join([f"{msg['role']}: {msg['content']}" for msg in messages])
-    try:
-        prompt_template = load_summarize_prompt(language)
-        prompt = prompt_template.format(conversation_text=conversation_text, previous_summary=previous_summary_text or "")
-        
-        response = model.generate_content(prompt)
-        # Basic parsing to handle potential markdown in response
-        summary_text = response.text.strip().lstrip("```json").rstrip("```")
-        summary_obj = json.loads(summary_text)
-
-        # Insert the new finalized record
-        insert_finalized_summary(supabase, key, conversation_id, user_id, summary_obj, previous_record_id)
-
-    except Exception as e:
-        st.error(f"Failed to finalize summary: {e}")
\ No newline at end of file
+    # Uploaded documents (Files API parts) are passed along after the prompt, so the summary can still draw on them
+    files, lines = [], []
+    for turn in turns:
+        texts = []
+        for part in turn["parts"]:
+            if isinstance(part, str):
+                texts.append(part)
+            else:
+                files.append(part)
+                texts.append(f"[attached document {len(files)}, included after this prompt]")
+        lines.append(f"{turn['role']}: " + " ".join(texts))
+    prompt = render_prompt(load_running_summary_prompt(language), conversation_text="\n".join(lines), previous_summary=previous_summary)
+    return model.generate_content([prompt, *files]).text.strip()
\ No newline at end of file
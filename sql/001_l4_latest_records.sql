@@ -0,0 +1,12 @@
+-- Latest L4 record per conversation, so the sidebar fetches one row per
+-- conversation instead of every summary revision.
+-- security_invoker keeps the RLS policies of l4_structured_records in force.
+create or replace view l4_latest_records
+with (security_invoker = true) as
+select distinct on (conversation_id)
+    conversation_id,
+    user_id,
+    summary_data,
+    created_at
+from l4_structured_records
+order by conversation_id, created_at desc;
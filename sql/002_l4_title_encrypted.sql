@@ -0,0 +1,16 @@
+-- Encrypted sidebar title (the why_summary alone), so the sidebar no longer
+-- downloads and decrypts whole summaries. Older rows keep a null title and
+-- fall back to summary_data.
+alter table l4_structured_records add column if not exists title_encrypted text;
+
+drop view if exists l4_latest_records;
+create view l4_latest_records
+with (security_invoker = true) as
+select distinct on (conversation_id)
+    conversation_id,
+    user_id,
+    coalesce(title_encrypted, summary_data) as title_data,
+    title_encrypted is not null as has_title,
+    created_at
+from l4_structured_records
+order by conversation_id, created_at desc;
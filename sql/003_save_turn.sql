@@ -0,0 +1,17 @@
+-- Writes one chat turn in a single round-trip and transaction: the turn's L5
+-- messages and, for the first turn of a conversation, its interim L4 record.
+-- Rows arrive already encrypted; security invoker keeps RLS in force.
+create or replace function save_turn(messages jsonb, interim_summary jsonb default null)
+returns void
+language sql
+security invoker
+as $$
+    insert into l5_raw_messages (conversation_id, role, content, user_id, created_at)
+    select conversation_id, role, content, user_id, created_at
+    from jsonb_populate_recordset(null::l5_raw_messages, messages);
+
+    insert into l4_structured_records (user_id, conversation_id, summary_data, title_encrypted, status)
+    select user_id, conversation_id, summary_data, title_encrypted, 'interim'
+    from jsonb_populate_record(null::l4_structured_records, interim_summary)
+    where interim_summary is not null;
+$$;
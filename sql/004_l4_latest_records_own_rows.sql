@@ -0,0 +1,15 @@
+-- Restrict l4_latest_records to the caller's rows inside the view. A filter
+-- on user_id applied from outside cannot be pushed below DISTINCT ON (it is
+-- not a DISTINCT ON column), so without this the view deduplicated every row
+-- visible to the caller before PostgREST's user_id filter was applied.
+create or replace view l4_latest_records
+with (security_invoker = true) as
+select distinct on (conversation_id)
+    conversation_id,
+    user_id,
+    coalesce(title_encrypted, summary_data) as title_data,
+    title_encrypted is not null as has_title,
+    created_at
+from l4_structured_records
+where user_id = auth.uid()
+order by conversation_id, created_at desc;
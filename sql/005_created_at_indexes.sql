@@ -0,0 +1,14 @@
+-- Composite indexes matching how the app filters and orders: L5 messages by
+-- conversation in created_at order, the latest L4 record per conversation,
+-- and a user's L4 records newest first. The sidebar view's DISTINCT ON sort
+-- is served by the index in 007 instead.
+-- Plain CREATE INDEX so the file runs in the SQL editor's transaction; on a
+-- large live table, run each statement by hand with CONCURRENTLY instead.
+create index if not exists idx_l5_conv_ts
+    on l5_raw_messages (conversation_id, created_at);
+
+create index if not exists idx_l4_conv_ts
+    on l4_structured_records (conversation_id, created_at desc);
+
+create index if not exists idx_l4_user_ts
+    on l4_structured_records (user_id, created_at desc);
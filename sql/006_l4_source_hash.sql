@@ -0,0 +1,4 @@
+-- Fingerprint of the L5 ciphertexts a finalized summary was built from, so
+-- finalizing a conversation with no new messages can skip the Gemini call.
+-- Interim drafts and older records leave it null and are always refreshed.
+alter table l4_structured_records add column if not exists source_hash text;
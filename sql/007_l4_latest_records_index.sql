@@ -0,0 +1,6 @@
+-- Index for l4_latest_records: rows of one user (the view's auth.uid()
+-- filter) already in its DISTINCT ON (conversation_id) ... ORDER BY
+-- conversation_id, created_at DESC order, so the view needs no sort.
+-- As in 005, run by hand with CONCURRENTLY on a large live table.
+create index if not exists idx_l4_user_conv_ts
+    on l4_structured_records (user_id, conversation_id, created_at desc);
@@ -1,16 +1,22 @@
 import streamlit as st
-import pandas as pd
 import json
+import functools
+import hashlib
+import itertools
+from datetime import datetime, timezone
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from supabase import Client
+from postgrest.types import ReturnMethod
 
 # Import constants and helpers from our new modules
-from config import TABLE_L5_RAW_MESSAGES, TABLE_L4_STRUCTURED_RECORDS
-from crypto_utils import encrypt_message, decrypt_message
+from config import TABLE_L5_RAW_MESSAGES, TABLE_L4_STRUCTURED_RECORDS, VIEW_L4_LATEST_RECORDS, HISTORY_PAGE_SIZE
+from crypto_utils import encrypt_message, decrypt_message, decrypt_messages
 
 # --- Decorator for Error Handling ---
 def handle_db_errors(default_return_value=None):
     """A decorator to handle Supabase exceptions and show errors in Streamlit."""
     def decorator(func):
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
             try:
                 return func(*args, **kwargs)
@@ -20,86 +26,206 @@ def handle_db_errors(default_return_value=None):
         return wrapper
     return decorator
 
-# --- Database Functions ---
+# --- Background Writes ---
+@st.cache_resource
+def get_db_executor() -> ThreadPoolExecutor:
+    """Returns the worker pool used to run Supabase I/O off the script thread."""
+    return ThreadPoolExecutor(max_workers=4)
 
-@handle_db_errors()
-def save_message(supabase: Client, key: bytes, conversation_id: str, role: str, content: str, user_id: str):
-    """Saves a raw L5 message to the database."""
-    encrypted_content = encrypt_message(content, key)
-    supabase.table(TABLE_L5_RAW_MESSAGES).insert({
-        "conversation_id": conversation_id, "role": role,
-        "content": encrypted_content, "user_id": user_id
-    }).execute()
+# --- Conversation History Cache ---
+@st.cache_resource
+def _history_revisions() -> tuple:
+    # Per user and process-wide, like the history cache itself, so every tab of a user sees every bump.
+    # next() on the count is atomic, so concurrent bumps never hand out the same revision.
+    return {}, itertools.count(1)
 
-@handle_db_errors(default_return_value=[])
-def load_messages_for_conversation(supabase: Client, key: bytes, conversation_id: str):
-    """Loads and decrypts all L5 messages for a given conversation."""
-    response = supabase.table(TABLE_L5_RAW_MESSAGES).select("role, content").eq("conversation_id", conversation_id).order("created_at", desc=False).execute()
-    decrypted_messages = []
-    for msg in response.data:
-        try:
-            decrypted_content = decrypt_message(msg['content'], key)
-            decrypted_messages.append({'role': msg['role'], 'content': decrypted_content})
-        except Exception:
-            decrypted_messages.append({'role': msg['role'], 'content': '[Cannot Decrypt Message]'})
-    return decrypted_messages
+def conversation_history_rev(user_id: str) -> int:
+    """Returns the user's conversation-history revision, used as a cache key."""
+    revisions, _ = _history_revisions()
+    return revisions.get(user_id, 0)
 
-@handle_db_errors()
-def create_interim_summary(supabase: Client, key: bytes, conversation_id: str, user_id: str, first_message_content: str):
-    """Creates an encrypted, interim L4 record."""
-    summary_obj = {
+def invalidate_conversation_history(user_id: str):
+    """Bumps the user's revision so the next history load in any of their sessions bypasses its cache."""
+    revisions, counter = _history_revisions()
+    revisions[user_id] = next(counter)
+
+@st.cache_data(max_entries=1000, show_spinner=False)
+def _decrypt_preview(title_data: str, has_title: bool, key: bytes) -> str:
+    """Decrypts an L4 sidebar title; cached per ciphertext.
+    Records written before title_encrypted existed carry the full summary instead."""
+    if has_title:
+        return decrypt_message(title_data, key)
+    summary_obj = json.loads(decrypt_message(title_data, key))
+    return summary_obj.get('why_summary', '[Cannot read summary]')
+
+# --- Database Functions ---
+
+def _dump_summary(summary_obj: dict) -> str:
+    # Compact, non-ASCII-escaped JSON: fewer bytes to encrypt, base64-encode and send
+    return json.dumps(summary_obj, ensure_ascii=False, separators=(",", ":"))
+
+def build_interim_summary(first_message_content: str) -> dict:
+    """Builds the draft L4 summary recorded with the first turn of a conversation."""
+    return {
         "why_summary": "[下書き] " + first_message_content[:50].strip() + "...",
         "what_summary": first_message_content[:100].strip(),
         "how_summary": ""
     }
-    encrypted_summary = encrypt_message(json.dumps(summary_obj, ensure_ascii=False), key)
-    supabase.table(TABLE_L4_STRUCTURED_RECORDS).insert({
-        "user_id": user_id,
-        "conversation_id": conversation_id,
-        "summary_data": encrypted_summary,
-        "status": "interim"
+
+def _save_turn(supabase: Client, key: bytes, conversation_id: str, messages: list, user_id: str, interim_summary: dict):
+    interim_record = None
+    if interim_summary:
+        interim_record = {
+            "user_id": user_id,
+            "conversation_id": conversation_id,
+            "summary_data": encrypt_message(_dump_summary(interim_summary), key),
+            "title_encrypted": encrypt_message(interim_summary["why_summary"], key)
+        }
+    supabase.rpc("save_turn", {
+        "messages": [{
+            "conversation_id": msg["conversation_id"], "role": msg["role"],
+            "content": encrypt_message(msg["content"], key), "user_id": user_id,
+            "created_at": msg["created_at"]
+        } for msg in messages],
+        "interim_summary": interim_record
     }).execute()
-    st.toast(f"Draft saved.")
 
-@handle_db_errors(default_return_value=(None, None))
-def get_latest_l4_record(supabase: Client, key: bytes, conversation_id: str):
-    """Fetches and decrypts the most recent L4 record for a conversation."""
-    response = supabase.table(TABLE_L4_STRUCTURED_RECORDS).select("id, summary_data").eq("conversation_id", conversation_id).order("created_at", desc=True).limit(1).execute()
-    if response.data:
-        record_id = response.data[0]['id']
-        decrypted_summary = decrypt_message(response.data[0]['summary_data'], key)
-        return record_id, decrypted_summary
-    return None, None
+def queue_message(conversation_id: str, role: str, content: str):
+    """Buffers a raw L5 message until the next flush_messages call.
+    The client-side created_at keeps rows written in one batch in order."""
+    st.session_state.setdefault("pending_writes", []).append({
+        "conversation_id": conversation_id, "role": role, "content": content,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    })
+
+def queue_interim_summary(conversation_id: str, interim_summary: dict):
+    """Buffers a conversation's interim L4 summary until the next flush_messages call.
+    Buffered as soon as it is built, so a rerun cutting the turn short cannot lose it."""
+    st.session_state.setdefault("pending_interims", {})[conversation_id] = interim_summary
+
+def flush_messages(supabase: Client, key: bytes, user_id: str):
+    """Writes all buffered messages through the save_turn RPC on the background pool, one call per conversation.
+    A conversation's buffered interim summary is written in the same transaction as its messages.
+    Failures surface via settle_background_writes, which puts the rows and interim summary back in the buffer."""
+    interims = st.session_state.get("pending_interims", {})
+    messages = st.session_state.get("pending_writes", [])
+    if not messages and not interims:
+        return
+    st.session_state.pending_writes = []
+    st.session_state.pending_interims = {}
+    # Usually a single conversation; rows from an earlier failed write may belong to another one
+    by_conversation = {}
+    for msg in messages:
+        by_conversation.setdefault(msg["conversation_id"], []).append(msg)
+    for pending_id in interims:
+        by_conversation.setdefault(pending_id, [])
+    for pending_id, rows in by_conversation.items():
+        interim = interims.get(pending_id)
+        future = get_db_executor().submit(_save_turn, supabase, key, pending_id, rows, user_id, interim)
+        st.session_state.setdefault("write_futures", []).append((future, rows, pending_id, interim, user_id))
+
+def settle_background_writes(block: bool = False):
+    """Reports finished background writes; rows and interim summaries that failed go back into the buffer for the next flush.
+    A saved interim summary bumps the history revision, so the user's other tabs list the new conversation.
+    With block=True, waits for all outstanding writes first (e.g. before reading L5 back)."""
+    pending = st.session_state.get("write_futures", [])
+    if block:
+        wait([future for future, *_ in pending])
+    failed_messages, failed_interims, still_running = [], {}, []
+    for future, messages, conversation_id, interim_summary, user_id in pending:
+        if not future.done():
+            still_running.append((future, messages, conversation_id, interim_summary, user_id))
+        elif future.exception():
+            st.error(f"Database operation failed in save_turn: {future.exception()}")
+            failed_messages.extend(messages)
+            if interim_summary:
+                failed_interims[conversation_id] = interim_summary
+        elif interim_summary:
+            invalidate_conversation_history(user_id)
+    st.session_state.write_futures = still_running
+    st.session_state.pending_writes = failed_messages + st.session_state.get("pending_writes", [])
+    st.session_state.pending_interims = {**failed_interims, **st.session_state.get("pending_interims", {})}
+
+def discard_pending_messages():
+    """Waits for in-flight writes, then drops unsaved rows (on logout, when their key goes away)."""
+    settle_background_writes(block=True)
+    st.session_state.pending_writes = []
+    st.session_state.pending_interims = {}
+
+def load_raw_messages(supabase: Client, conversation_id: str) -> list:
+    """Fetches a conversation's L5 rows, still encrypted, in created_at order. Raises on errors."""
+    response = supabase.table(TABLE_L5_RAW_MESSAGES).select("role, content").eq("conversation_id", conversation_id).order("created_at", desc=False).execute()
+    return response.data
+
+def decrypt_raw_messages(rows: list, key: bytes) -> list:
+    """Decrypts L5 rows as returned by load_raw_messages into chat messages."""
+    contents = decrypt_messages([msg['content'] for msg in rows], key, '[Cannot Decrypt Message]')
+    return [{'role': msg['role'], 'content': content} for msg, content in zip(rows, contents)]
+
+def messages_source_hash(rows: list) -> str:
+    """Fingerprints a conversation's stored L5 rows, in order.
+    Ciphertexts never change once written, so an equal hash means no message was added."""
+    return hashlib.sha256(b"\n".join(msg['content'].encode() for msg in rows)).hexdigest()
+
+def _load_messages(supabase: Client, key: bytes, conversation_id: str):
+    rows = load_raw_messages(supabase, conversation_id)
+    return decrypt_raw_messages(rows, key), messages_source_hash(rows)
+
+def prefetch_messages_for_conversation(supabase: Client, key: bytes, conversation_id: str) -> Future:
+    """Starts loading a conversation's messages on the background pool.
+    Lets the fetch overlap other work; read the result with collect_messages."""
+    return get_db_executor().submit(_load_messages, supabase, key, conversation_id)
+
+@handle_db_errors(default_return_value=([], None))
+def collect_messages(future: Future):
+    """Waits for a prefetch and returns its decrypted messages and their messages_source_hash."""
+    return future.result()
+
+def get_latest_l4_row(supabase: Client, conversation_id: str):
+    """Fetches the id, source_hash and status of a conversation's most recent L4 record, or None. Raises on errors.
+    The summary itself is left out; fetch it with get_l4_summary only when it is needed."""
+    response = supabase.table(TABLE_L4_STRUCTURED_RECORDS).select("id, source_hash, status").eq("conversation_id", conversation_id).order("created_at", desc=True).limit(1).execute()
+    return response.data[0] if response.data else None
+
+def get_l4_summary(supabase: Client, key: bytes, record_id: str) -> str:
+    """Fetches and decrypts one L4 record's summary. Raises on errors."""
+    response = supabase.table(TABLE_L4_STRUCTURED_RECORDS).select("summary_data").eq("id", record_id).single().execute()
+    return decrypt_message(response.data['summary_data'], key)
 
 @handle_db_errors()
-def insert_finalized_summary(supabase: Client, key: bytes, conversation_id: str, user_id: str, summary_obj: dict, supersedes_id: str):
-    """Inserts a new 'finalized' L4 record into the database."""
-    encrypted_summary = encrypt_message(json.dumps(summary_obj, ensure_ascii=False), key)
+def get_latest_finalized_summary(supabase: Client, key: bytes, conversation_id: str, source_hash: str):
+    """Fetches and decrypts the most recent finalized L4 summary for a conversation,
+    if one was built from exactly the L5 rows with this messages_source_hash."""
+    response = supabase.table(TABLE_L4_STRUCTURED_RECORDS).select("summary_data").eq("conversation_id", conversation_id).eq("status", "finalized").eq("source_hash", source_hash).order("created_at", desc=True).limit(1).execute()
+    if response.data:
+        return decrypt_message(response.data[0]['summary_data'], key)
+    return None
+
+def insert_finalized_summary(supabase: Client, key: bytes, conversation_id: str, user_id: str, summary_obj: dict, supersedes_id: str, source_hash: str = None):
+    """Inserts a new 'finalized' L4 record into the database. Raises on errors."""
+    encrypted_summary = encrypt_message(_dump_summary(summary_obj), key)
     supabase.table(TABLE_L4_STRUCTURED_RECORDS).insert({
         "user_id": user_id,
         "conversation_id": conversation_id,
         "summary_data": encrypted_summary,
+        "title_encrypted": encrypt_message(summary_obj.get("why_summary", "[Cannot read summary]"), key),
         "status": "finalized",
-        "supersedes_id": supersedes_id
-    }).execute()
-    st.toast(f"Knowledge crystallized!")
+        "supersedes_id": supersedes_id,
+        "source_hash": source_hash
+    }, returning=ReturnMethod.minimal).execute()  # Nothing reads the row back
 
 @handle_db_errors(default_return_value=[])
-def load_conversation_history(supabase: Client, key: bytes, user_id: str):
-    """Loads and decrypts the latest L4 record title for each conversation."""
-    response = supabase.table(TABLE_L4_STRUCTURED_RECORDS).select("conversation_id, summary_data, created_at").eq("user_id", user_id).order("created_at", desc=True).execute()
+@st.cache_data(ttl=60, show_spinner=False)
+def load_conversation_history(_supabase: Client, key: bytes, user_id: str, rev: int = 0, limit: int = HISTORY_PAGE_SIZE):
+    """Loads and decrypts the latest L4 record title for the `limit` most recent conversations, oldest first.
+    Cached for a minute per user; pass conversation_history_rev(user_id) as `rev` to pick up new records."""
+    response = _supabase.table(VIEW_L4_LATEST_RECORDS).select("conversation_id, title_data, has_title").eq("user_id", user_id).order("created_at", desc=True).limit(limit).execute()
     if not response.data: return []
     
-    df = pd.DataFrame(response.data)
-    latest_records_df = df.drop_duplicates(subset=['conversation_id'])
-    latest_records_df = latest_records_df.sort_values(by="created_at", ascending=True)
-    
     history_list = []
-    for index, row in latest_records_df.iterrows():
+    for row in reversed(response.data):
         try:
-            decrypted_summary = decrypt_message(row['summary_data'], key)
-            summary_obj = json.loads(decrypted_summary)
-            preview_title = summary_obj.get('why_summary', '[Cannot read summary]')
+            preview_title = _decrypt_preview(row['title_data'], row['has_title'], key)
             history_list.append({'conversation_id': row['conversation_id'], 'preview': preview_title})
         except Exception:
             history_list.append({'conversation_id': row['conversation_id'], 'preview': '[Cannot Decrypt Summary]'})
@@ -1,6 +1,8 @@
 import streamlit as st
+import string
+import uuid
 
-@st.cache_data
+@st.cache_resource(show_spinner=False)
 def load_prompt(language):
     """Loads the system prompt from a file."""
     try:
@@ -11,12 +13,49 @@ def load_prompt(language):
         st.error(f"Prompt file for {language} not found.")
         return "You are a helpful assistant."
 
-@st.cache_data
+def compile_prompt(template):
+    """Splits a str.format-style template into (literal, field_name) pairs once,
+    so each render is a single join instead of a re-parse of the template."""
+    return tuple((literal, field) for literal, field, _, _ in string.Formatter().parse(template))
+
+def render_prompt(parts, **fields):
+    """Fills a compile_prompt template; every field it names must be passed."""
+    return "".join(literal if field is None else literal + str(fields[field]) for literal, field in parts)
+
+@st.cache_resource(show_spinner=False)
 def load_summarize_prompt(language):
-    """Loads the summarization prompt from a file."""
+    """Loads the summarization prompt from a file, compiled for render_prompt."""
     try:
         filename = f"prompts/summarize_why_prompt_{language}.txt"
         with open(filename, "r", encoding="utf-8") as f:
-            return f.read()
+            return compile_prompt(f.read())
+    except FileNotFoundError:
+        return compile_prompt("Summarize the following conversation: {conversation_text}")
+
+@st.cache_resource(show_spinner=False)
+def load_running_summary_prompt(language):
+    """Loads the prompt used to fold older chat turns into a running summary, compiled for render_prompt."""
+    try:
+        filename = f"prompts/running_summary_prompt_{language}.txt"
+        with open(filename, "r", encoding="utf-8") as f:
+            return compile_prompt(f.read())
     except FileNotFoundError:
-        return "Summarize the following conversation: {conversation_text}"
\ No newline at end of file
+        return compile_prompt("Update this summary: {previous_summary}\n\nWith these turns:\n{conversation_text}")
+
+@st.cache_resource
+def get_history_prefix(language):
+    """Returns the system-prompt turns that open every chat request.
+    Shared across reruns and sessions, so callers must not mutate it."""
+    return (
+        {"role": "user", "parts": [load_prompt(language)]},
+        {"role": "model", "parts": ["Understood."]},
+    )
+
+def to_api_turn(role, content):
+    """Converts a chat message into a Gemini content turn."""
+    return {"role": "user" if role == "user" else "model", "parts": [content]}
+
+def new_conversation_id():
+    """Returns a fresh conversation id in canonical (dashed) UUID form.
+    Supabase returns uuid columns in this form, and ids are compared against it and used as cache keys."""
+    return str(uuid.uuid4())
\ No newline at end of file